@@ -0,0 +1,52 @@
+import hashlib
+
+import diskcache
+
+# -------------------------------------------------
+# CONFIG
+# -------------------------------------------------
+
+CACHE_DIR = "./.llm_cache"
+CACHE_EXPIRE = 7 * 86400  # one week
+
+_cache = diskcache.Cache(CACHE_DIR)
+
+# Hit/miss counters for the current process (shown in the sidebar)
+stats = {"hits": 0, "misses": 0}
+
+# -------------------------------------------------
+# HELPERS
+# -------------------------------------------------
+
+def image_hash(raw_bytes: bytes) -> str:
+    """
+    128-bit blake2b of the raw image bytes.
+    Faster than sha256 on multi-MB inputs and plenty for a cache key.
+    """
+    return hashlib.blake2b(raw_bytes, digest_size=16).hexdigest()
+
+
+def make_key(*parts) -> str:
+    """
+    Build a cache key from model, prompt parameters and image hash.
+    Parts are NUL-separated so ("ab", "c") and ("a", "bc") never collide.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def cache_get(key: str):
+    """Return the cached response for `key`, or None on a miss."""
+    value = _cache.get(key)
+    if value is None:
+        stats["misses"] += 1
+    else:
+        stats["hits"] += 1
+    return value
+
+
+def cache_set(key: str, value) -> None:
+    _cache.set(key, value, expire=CACHE_EXPIRE)
@@ -1,32 +1,55 @@
 import streamlit as st
-import requests
-import json
+import aiohttp
+import orjson
+import asyncio
 import base64
+import binascii
 import io
 import zipfile
 import time
 
+import llm_cache
+
 # --- Configuration ---
 # Models as specified in your request. 
 # Note: If 'openai/gpt-5' is not available, try 'openai/gpt-4o'.
 ANALYSIS_MODEL = "openai/gpt-5" 
 GENERATION_MODEL = "google/gemini-3-pro-image-preview"
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+MAX_WORKERS = 6
+# Per request, not per queue wait: no total cap, only connect and read stalls
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+B64_CHUNK_SIZE = 3 * 4096 # Multiple of 3, so encoded chunks concatenate without padding
+
+# --- Prompts ---
+# Formatted once per batch (see process_all_images), not once per image.
+
+LOCALIZATION_PROMPT_TEMPLATE = """You are a meticulous product/visual QA analyst. Your job is to scan a single product image and identify only the text that belongs to infographic/overlay/UI elements that should be localized into {language} for a {language}  product page.  Critical scope rules (read carefully)  Translate (include in the list):  Text in overlays, badges, banners, callouts, captions, labels, pointers/arrows, corner tags, stickers, footer/header bars, or any post-production infographic panel placed on top of the image.  Do NOT translate (exclude from the list):  Any text printed on the physical product or its packaging/label (e.g., bottle/jar/box/cap/handle).  Logos, brand names, model names/numbers, trademarks, certification marks (CE, UL, etc.), QR codes, barcodes, URLs, social handles, app icons.  Watermarks or photographer/brand credits.  Text that is unreadable due to resolution; mark as UNREADABLE only if it’s clearly an overlay but cannot be read (still provide position_hint, and set changed_to to "").  When unsure whether text is product-bound vs overlay: If it follows the product’s surface perspective/curvature, lighting, or material (gloss/matte/emboss), treat it as product/packaging → EXCLUDE. If it sits flat in screen space with uniform sharpness, drop shadows, or graphic shapes, treat it as overlay → INCLUDE.  Output format (strict)  Return a JSON array. Each item must have exactly three fields:  "what_text": the exact source text string as it appears (trim whitespace; preserve casing/punctuation). If the block is bullets/lines, keep line breaks using \n.  "position_hint": a concise, human-friendly locator using plain language (see allowed vocabulary below).  "changed_to": the natural, fluent {language} translation suitable for ecommerce. If the item is UNREADABLE, set to "".  No extra keys, no commentary outside the JSON.  Positioning vocabulary (use these patterns)  Compose "position_hint" using one or more of the following, separated by “ — ” if needed:  Regions: top-left, top-center, top-right, mid-left, center, mid-right, bottom-left, bottom-center, bottom-right  Containers/graphics: header banner, footer strip, round badge, ribbon, sidebar panel, callout box, sticker, corner tag  Line/sequence cues (when text spans lines/bullets): first line, second line, third line, bullet 1, bullet 2, …  Relative anchors (optional): above product, below product, left of product, right of product, over product background, next to logo (only as a landmark; do not translate the logo)  Examples:  top-left — header banner  mid-right — round badge  bottom-center — footer strip — second line  left of product — callout box — bullet 3  Be brief and unambiguous. If the same phrase appears in multiple overlay locations, list each occurrence separately with its own "position_hint". {language}  localization guidance  Tone: concise, neutral/professional ecommerce copy; avoid over-formality.  Keep brand names, product names, model numbers, trademarks, URLs in English (do not translate).  Prefer natural and easy {language} translation or word selection over literal translation; localize idioms.  Keep Arabic numerals as in source (e.g., “12”, “3.5mm”). Do not change units unless clearly part of marketing copy.  Edge cases  If an overlay contains both text and a logo, include only the text portion in "what_text"; exclude the logo.  If text is partially occluded but readable, include it; if not readable, mark as UNREADABLE with changed_to: "".  Ignore decorative letters/numbers that have no marketing meaning (unless they read as “SALE”, “NEW”, “X2”, etc.).  Quality checks before you output  Verify that no product/packaging text or logos appear in the list.  Ensure every item has a clear "position_hint" using the vocabulary above and a {language} translation (or "" if unreadable overlay). additional important instruction from the user{additional_instructions}"""
 
 # --- Helper Functions ---
 
 def encode_image_to_base64(uploaded_file):
-    """Converts a Streamlit UploadedFile to a base64 string."""
-    bytes_data = uploaded_file.getvalue()
-    base64_str = base64.b64encode(bytes_data).decode('utf-8')
-    mime_type = uploaded_file.type
-    return f"data:{mime_type};base64,{base64_str}"
+    """
+    Converts a Streamlit UploadedFile to a base64 string.
+    Reads and encodes in chunks so no full-size intermediate copy is built.
+    """
+    buf = io.BytesIO()
+    buf.write(f"data:{uploaded_file.type};base64,".encode('ascii'))
+    uploaded_file.seek(0)
+    while chunk := uploaded_file.read(B64_CHUNK_SIZE):
+        buf.write(binascii.b2a_base64(chunk, newline=False))
+    return buf.getvalue().decode('ascii')
 
-def analyze_image(api_key, base64_image_url, language, additional_instructions):
+async def analyze_image(session, api_key, base64_image_url, image_hash, analysis_prompt):
     """
     Step 1: Analyzes the image using the specified analysis model.
+    Responses are cached on disk by (model, prompt, image hash).
     """
-    analysis_prompt=f"""You are a meticulous product/visual QA analyst. Your job is to scan a single product image and identify only the text that belongs to infographic/overlay/UI elements that should be localized into {language} for a {language}  product page.  Critical scope rules (read carefully)  Translate (include in the list):  Text in overlays, badges, banners, callouts, captions, labels, pointers/arrows, corner tags, stickers, footer/header bars, or any post-production infographic panel placed on top of the image.  Do NOT translate (exclude from the list):  Any text printed on the physical product or its packaging/label (e.g., bottle/jar/box/cap/handle).  Logos, brand names, model names/numbers, trademarks, certification marks (CE, UL, etc.), QR codes, barcodes, URLs, social handles, app icons.  Watermarks or photographer/brand credits.  Text that is unreadable due to resolution; mark as UNREADABLE only if it’s clearly an overlay but cannot be read (still provide position_hint, and set changed_to to "").  When unsure whether text is product-bound vs overlay: If it follows the product’s surface perspective/curvature, lighting, or material (gloss/matte/emboss), treat it as product/packaging → EXCLUDE. If it sits flat in screen space with uniform sharpness, drop shadows, or graphic shapes, treat it as overlay → INCLUDE.  Output format (strict)  Return a JSON array. Each item must have exactly three fields:  "what_text": the exact source text string as it appears (trim whitespace; preserve casing/punctuation). If the block is bullets/lines, keep line breaks using \n.  "position_hint": a concise, human-friendly locator using plain language (see allowed vocabulary below).  "changed_to": the natural, fluent {language} translation suitable for ecommerce. If the item is UNREADABLE, set to "".  No extra keys, no commentary outside the JSON.  Positioning vocabulary (use these patterns)  Compose "position_hint" using one or more of the following, separated by “ — ” if needed:  Regions: top-left, top-center, top-right, mid-left, center, mid-right, bottom-left, bottom-center, bottom-right  Containers/graphics: header banner, footer strip, round badge, ribbon, sidebar panel, callout box, sticker, corner tag  Line/sequence cues (when text spans lines/bullets): first line, second line, third line, bullet 1, bullet 2, …  Relative anchors (optional): above product, below product, left of product, right of product, over product background, next to logo (only as a landmark; do not translate the logo)  Examples:  top-left — header banner  mid-right — round badge  bottom-center — footer strip — second line  left of product — callout box — bullet 3  Be brief and unambiguous. If the same phrase appears in multiple overlay locations, list each occurrence separately with its own "position_hint". {language}  localization guidance  Tone: concise, neutral/professional ecommerce copy; avoid over-formality.  Keep brand names, product names, model numbers, trademarks, URLs in English (do not translate).  Prefer natural and easy {language} translation or word selection over literal translation; localize idioms.  Keep Arabic numerals as in source (e.g., “12”, “3.5mm”). Do not change units unless clearly part of marketing copy.  Edge cases  If an overlay contains both text and a logo, include only the text portion in "what_text"; exclude the logo.  If text is partially occluded but readable, include it; if not readable, mark as UNREADABLE with changed_to: "".  Ignore decorative letters/numbers that have no marketing meaning (unless they read as “SALE”, “NEW”, “X2”, etc.).  Quality checks before you output  Verify that no product/packaging text or logos appear in the list.  Ensure every item has a clear "position_hint" using the vocabulary above and a {language} translation (or "" if unreadable overlay). additional important instruction from the user{additional_instructions}"""
+    cache_key = llm_cache.make_key("LOCALIZATION", ANALYSIS_MODEL, analysis_prompt, image_hash)
+    cached = llm_cache.cache_get(cache_key)
+    if cached is not None:
+        return cached, None
+
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
@@ -59,21 +82,22 @@ def analyze_image(api_key, base64_image_url, language, additional_instructions):
     }
 
     try:
-        response = requests.post(OPENROUTER_URL, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-        result = response.json()
+        async with session.post(OPENROUTER_URL, headers=headers, data=orjson.dumps(payload)) as response:
+            response.raise_for_status()
+            result = orjson.loads(await response.read())
         
         # Extract content
         if 'choices' in result and len(result['choices']) > 0:
             analysis_text = result['choices'][0]['message']['content']
+            llm_cache.cache_set(cache_key, analysis_text)
             return analysis_text, None
         else:
             return None, "No choices returned from Analysis API"
             
     except Exception as e:
-        return None, str(e)
+        return None, str(e) or repr(e)  # TimeoutError has an empty str()
 
-def generate_image_from_analysis(api_key, analysis_text, base64_original_image):
+async def generate_image_from_analysis(session, api_key, analysis_text, base64_original_image):
     """
     Step 2: Generates a new image based on the analysis text and the original image.
     Uses the Gemini image preview model logic provided.
@@ -109,9 +133,9 @@ def generate_image_from_analysis(api_key, analysis_text, base64_original_image):
     }
 
     try:
-        response = requests.post(OPENROUTER_URL, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()
-        result = response.json()
+        async with session.post(OPENROUTER_URL, headers=headers, data=orjson.dumps(payload)) as response:
+            response.raise_for_status()
+            result = orjson.loads(await response.read())
 
         # Logic to extract image from the special Gemini/OpenRouter response format
         if result.get("choices"):
@@ -134,7 +158,91 @@ def generate_image_from_analysis(api_key, analysis_text, base64_original_image):
         return None, "No image generated in response"
 
     except Exception as e:
-        return None, str(e)
+        return None, str(e) or repr(e)  # TimeoutError has an empty str()
+
+async def process_image(session, api_key, uploaded_file, analysis_prompt):
+    """
+    Runs the analysis -> generation chain for a single uploaded file.
+    Returns a result dict, or an error dict if either step failed.
+    """
+    # 1. Prepare Image
+    # Keep encoding/hashing off the event loop (blake2b releases the GIL;
+    # base64 doesn't, but at ~1GB/s it only blocks for milliseconds)
+    base64_img = await asyncio.to_thread(encode_image_to_base64, uploaded_file)
+    image_hash = await asyncio.to_thread(llm_cache.image_hash, uploaded_file.getvalue())
+
+    # 2. Analyze Image
+    analysis_result, err = await analyze_image(session, api_key, base64_img, image_hash, analysis_prompt)
+    if err:
+        return {"original_name": uploaded_file.name, "error": f"Error analyzing {uploaded_file.name}: {err}"}
+
+    # 3. Generate New Image
+    generated_img_url, gen_err = await generate_image_from_analysis(session, api_key, analysis_result, base64_img)
+    if gen_err:
+        return {"original_name": uploaded_file.name, "error": f"Error generating for {uploaded_file.name}: {gen_err}"}
+
+    # Decode once; the ZIP and the results grid both reuse these bytes
+    try:
+        # generated_image is a data URI: "data:image/png;base64,....."
+        header, encoded = generated_img_url.split(",", 1)
+        generated_bytes = await asyncio.to_thread(base64.b64decode, encoded)
+    except Exception as e:
+        return {"original_name": uploaded_file.name, "error": f"Could not decode image for {uploaded_file.name}: {e}"}
+
+    return {
+        "original_name": uploaded_file.name,
+        "analysis": analysis_result,
+        "generated_bytes": generated_bytes,
+        "generated_hash": await asyncio.to_thread(llm_cache.image_hash, generated_bytes)
+    }
+
+async def process_all_images(api_key, uploaded_files, language, additional_instructions, on_done=None):
+    """
+    Processes all uploaded files concurrently over one shared session.
+    `on_done` is called after each image finishes (used for progress updates).
+    """
+    analysis_prompt = LOCALIZATION_PROMPT_TEMPLATE.format(
+        language=language, additional_instructions=additional_instructions
+    )
+
+    # Single host (openrouter.ai): cap per host, keep connections warm and cache DNS
+    connector = aiohttp.TCPConnector(
+        limit=MAX_WORKERS,
+        limit_per_host=MAX_WORKERS,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    # Only MAX_WORKERS images in flight, so payloads are built as slots free up
+    # and queued images don't sit in the connection pool wait
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    async with aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT) as session:
+        async def run(uploaded_file):
+            async with semaphore:
+                result = await process_image(session, api_key, uploaded_file, analysis_prompt)
+            if on_done:
+                on_done()
+            return result
+
+        return await asyncio.gather(*[run(f) for f in uploaded_files])
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_zip(generated_hashes, _results):
+    """
+    Builds the download ZIP. Cached on the tuple of generated-image hashes
+    (`_results` is not hashed), so reruns from sidebar interactions reuse it.
+    """
+    # ZIP_STORED: generated PNG/JPEG data is already compressed, DEFLATE only burns CPU
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_STORED, False) as zip_file:
+        for item in _results:
+            try:
+                file_name = f"generated_{item['original_name']}"
+                # Ensure extension is correct based on header if needed, defaulting to input ext
+                zip_file.writestr(file_name, item['generated_bytes'])
+            except Exception as e:
+                st.warning(f"Could not prepare {item['original_name']} for download: {e}")
+    return zip_buffer.getvalue()
 
 # --- Main App ---
 
@@ -151,6 +259,7 @@ def main():
         additional_instructions = st.text_input("Additional Instructions (optional)", type="default")
         uploaded_files = st.file_uploader("Upload Images", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True)
         process_btn = st.button("Process Images", type="primary")
+        cache_stats = st.empty()
 
     # Initialize Session State to hold results
     if 'results' not in st.session_state:
@@ -162,66 +271,47 @@ def main():
         
         progress_bar = st.progress(0)
         status_text = st.empty()
-        
-        for idx, uploaded_file in enumerate(uploaded_files):
-            status_text.text(f"Processing image {idx + 1} of {len(uploaded_files)}: {uploaded_file.name}...")
-            
-            # 1. Prepare Image
-            base64_img = encode_image_to_base64(uploaded_file)
-            
-            # 2. Analyze Image
-            analysis_result, err = analyze_image(api_key, base64_img, language, additional_instructions)
-            
-            if err:
-                st.error(f"Error analyzing {uploaded_file.name}: {err}")
-                continue
-                
-            # 3. Generate New Image
-            status_text.text(f"Generating variation for image {idx + 1}...")
-            generated_img_url, gen_err = generate_image_from_analysis(api_key, analysis_result, base64_img)
-            
-            if gen_err:
-                st.error(f"Error generating for {uploaded_file.name}: {gen_err}")
-                continue
+        status_text.text(f"Processing {len(uploaded_files)} images...")
+
+        done = 0
+
+        def on_done():
+            nonlocal done
+            done += 1
+            progress_bar.progress(done / len(uploaded_files))
+
+        results = asyncio.run(
+            process_all_images(api_key, uploaded_files, language, additional_instructions, on_done)
+        )
 
+        for result in results:
+            if "error" in result:
+                st.error(result["error"])
+                continue
             # 4. Store Result
-            st.session_state.results.append({
-                "original_name": uploaded_file.name,
-                "analysis": analysis_result,
-                "generated_image": generated_img_url
-            })
-            
-            # Update progress
-            progress_bar.progress((idx + 1) / len(uploaded_files))
+            st.session_state.results.append(result)
             
         status_text.text("Processing complete!")
         time.sleep(1)
         status_text.empty()
         progress_bar.empty()
 
+    cache_stats.caption(f"LLM cache: {llm_cache.stats['hits']} hits / {llm_cache.stats['misses']} misses")
+
     # Display Results Grid
     if st.session_state.results:
         st.divider()
         st.header("Results")
         
         # Download All Button Logic
-        # We need to process the base64 strings back to bytes for the ZIP
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-            for item in st.session_state.results:
-                try:
-                    # generated_image is a data URI: "data:image/png;base64,....."
-                    header, encoded = item['generated_image'].split(",", 1)
-                    img_data = base64.b64decode(encoded)
-                    file_name = f"generated_{item['original_name']}"
-                    # Ensure extension is correct based on header if needed, defaulting to input ext
-                    zip_file.writestr(file_name, img_data)
-                except Exception as e:
-                    st.warning(f"Could not prepare {item['original_name']} for download: {e}")
+        zip_data = build_zip(
+            tuple((item['original_name'], item['generated_hash']) for item in st.session_state.results),
+            st.session_state.results
+        )
         
         st.download_button(
             label="Download All Images (ZIP)",
-            data=zip_buffer.getvalue(),
+            data=zip_data,
             file_name="generated_images.zip",
             mime="application/zip"
         )
@@ -239,7 +329,7 @@ def main():
 
                 with col2:
                     st.caption("Generated (Gemini 3 Pro)")
-                    st.image(item['generated_image'], use_container_width=True)
+                    st.image(io.BytesIO(item['generated_bytes']), use_container_width=True)
                 
                 st.divider()
 
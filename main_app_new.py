@@ -1,20 +1,23 @@
 import streamlit as st
 import aiohttp
+import orjson
 import asyncio
-import json
 import base64
+import binascii
+import gzip
 import io
 import zipfile
+import tempfile
 import time
-import os
 import re
-import mimetypes
-from requests.exceptions import RequestException
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import uuid
+from PIL import Image, ImageOps
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from googleapiclient.errors import HttpError
+import llm_cache
 
 # -------------------------------------------------
 # CONFIG
@@ -24,15 +27,79 @@ ANALYSIS_MODEL = "google/gemini-3-flash-preview"
 GENERATION_MODEL = "google/gemini-3-pro-image-preview"
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
-REQUEST_TIMEOUT = 300
+# Per request, not per queue wait: no total cap, only connect and read stalls
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
 MAX_RETRIES = 3
+MAX_RETRY_AFTER = 60  # seconds; never wait longer than this on a Retry-After
+MAX_BACKOFF = 30  # seconds; cap on the exponential backoff
+MAX_RATE_LIMIT_RETRIES = 5  # 429 retries, on top of MAX_RETRIES
 MAX_WORKERS = 6
+ANALYSIS_BATCH_SIZE = 4  # images per localization request
+# Skip the analysis calls and let the image model localize in one round-trip.
+# Falls back to analysis + generation for images where it returns no image.
+COMBINED_MODE = False
+B64_CHUNK_SIZE = 3 * 4096  # multiple of 3, so encoded chunks concatenate without padding
+GZIP_MIN_BYTES = 64_000  # request bodies above this are sent gzip-compressed
+GZIP_FALLBACK_STATUSES = (400, 411, 413, 415, 422)  # replies to a gzipped body that trigger a plain resend
+MAX_INPUT_EDGE = 1536  # px; larger uploads are downscaled before being sent
+DOWNSCALE_JPEG_QUALITY = 85
 
 SERVICE_ACCOUNT_FILE = "drive_upload_service_account_key.json"
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+_FOLDER_RX = re.compile(r"folders/([a-zA-Z0-9_-]+)|id=([a-zA-Z0-9_-]+)")  # Drive folder URL -> id
+DRIVE_MAX_PARALLEL_UPLOADS = 6
+DRIVE_RESUMABLE_THRESHOLD = 5 * 1024 * 1024  # bytes; smaller files go up in one request
+DRIVE_MAX_RETRIES = 5  # backoff retries on 403 userRateLimitExceeded / 429 / 5xx
+ZIP_SPOOL_MAX_SIZE = 64 << 20  # archives larger than this are built on disk
 
-TEMP_DIR = "temp_images"
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Formatted once per batch in process_all_images_async, not once per image
+LOCALIZATION_PROMPT_TEMPLATE = """You are a meticulous product/visual QA analyst. Your job is to scan a single product image and identify only the text that belongs to infographic/overlay/UI elements that should be localized into {language} for a {language} product page.
+
+Critical scope rules:
+Translate:
+- Overlays, badges, banners, callouts, captions, labels, pointers, stickers, ribbons, corner tags, headers, footers.
+
+Do NOT translate:
+- Any text printed on the physical product or packaging.
+- Logos, brand names, model numbers, trademarks, certifications, addresses.
+- URLs, QR codes, barcodes, watermarks, icons.
+
+If unreadable but clearly overlay text, mark as UNREADABLE.
+
+Return STRICT JSON array with:
+- what_text
+- position_hint
+- changed_to
+
+Tone: concise, professional ecommerce copy.
+Do not remove or rewrite brand names.
+Preserve numerals and units.
+
+Additional user instructions:
+{extra}"""
+
+# Appended to the localization prompt in COMBINED_MODE
+COMBINED_INSTRUCTIONS = """Do not return the list. Instead, edit the provided image: replace each overlay text you identified with its translation, matching the original position, font style, size and colour. Leave everything else in the image unchanged."""
+
+ASPECT_PROMPT_TEMPLATE = """
+You are an expert visual layout and image composition specialist.
+
+Analyze the provided image and describe how to adapt it to a {ratio} aspect ratio, while still keeping all of the original elements of the image.
+
+Guidelines:
+- Preserve the main subject, background and focal point
+- Avoid aggressive cropping of oriiginal elements, rather reposition or resize them
+- Prefer intelligent expansion, repositioning, or background continuation
+- Maintain natural proportions
+- Ensure the image feels native to the target aspect ratio
+- Do not add new objects unless required for balance
+
+Return concise, actionable steps (3-4 bullet points max).
+Plain text only.
+Always add a prefix to your answerstating: Change the given imaget to {ratio} (mention the required aspect ratio) following the idea: followed by your description
+
+just the prefix and the description no preamble or commnetary or explanation
+"""
 
 ASPECT_RATIO_OPTIONS = {
     "Original": None,
@@ -48,68 +115,294 @@ ASPECT_RATIO_OPTIONS = {
 # -------------------------------------------------
 # GOOGLE DRIVE HELPERS
 # -------------------------------------------------
+# Google client libraries are imported inside these helpers, so the
+# first load (and any run without a Drive folder) doesn't pay for them.
+
+@st.cache_resource(show_spinner=False)
+def drive_credentials():
+    """
+    Service-account credentials, parsed once per process.
+    Shared by every session and thread (they refresh their own token);
+    Drive services are not, see thread_drive_service.
+    """
+    from google.oauth2 import service_account
 
-def drive_service():
     creds = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES
     )
     #st.write("🔐 Drive authenticated as:", creds.service_account_email)
-    return build("drive", "v3", credentials=creds)
+    return creds
+
+
+def drive_service(creds):
+    """
+    Build a Drive client on its own long-lived HTTP connection.
+    Uses the discovery doc bundled with googleapiclient, so nothing is fetched.
+    build_http() keeps googleapiclient's socket timeout and its 308 handling,
+    which resumable uploads rely on.
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+
+    http = AuthorizedHttp(creds, http=build_http())
+    return build("drive", "v3", http=http, cache_discovery=False, static_discovery=True)
 
 
 def extract_folder_id(url: str) -> str | None:
-    patterns = [
-        r"folders/([a-zA-Z0-9_-]+)",
-        r"id=([a-zA-Z0-9_-]+)"
-    ]
-    for p in patterns:
-        m = re.search(p, url)
-        if m:
-            return m.group(1)
-    return None
+    m = _FOLDER_RX.search(url)
+    return next((g for g in m.groups() if g), None) if m else None
+
 
+def verify_drive_folder_access(folder_ids: list[str], svc) -> bool:
+    """
+    Check the service account can upload into every folder.
+    All metadata lookups go out as one BatchHttpRequest (one round-trip
+    however many folders); write access is read from the same response.
+    """
+    from googleapiclient.errors import HttpError
+
+    folder_ids = list(dict.fromkeys(folder_ids))  # batch request ids must be unique
+    responses = {}
+
+    def collect(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = svc.new_batch_http_request(callback=collect)
+    for folder_id in folder_ids:
+        batch.add(
+            svc.files().get(
+                fileId=folder_id,
+                fields="id, name, capabilities(canAddChildren)"
+            ),
+            request_id=folder_id,
+        )
 
-def verify_drive_folder_access(folder_id: str, svc) -> bool:
     try:
-        folder = svc.files().get(
-            fileId=folder_id,
-            fields="id, name"
-        ).execute()
-        st.info(f"📁 Drive folder verified: {folder['name']}")
-        return True
+        batch.execute()
     except HttpError as e:
         st.error("❌ Drive folder not accessible. Share it with the service account.")
         st.error(str(e))
         return False
 
+    ok = True
+    for folder_id in folder_ids:
+        folder, err = responses[folder_id]
+        if err:
+            st.error("❌ Drive folder not accessible. Share it with the service account.")
+            st.error(str(err))
+            ok = False
+        elif not folder.get("capabilities", {}).get("canAddChildren", False):
+            st.error(f"❌ No write access to Drive folder {folder['name']}. Share it with the service account as Editor.")
+            ok = False
+        else:
+            st.info(f"📁 Drive folder verified: {folder['name']}")
+    return ok
 
-def drive_upload(local_path: str, folder_id: str, svc):
-    file_name = os.path.basename(local_path)
-    mime = mimetypes.guess_type(local_path)[0] or "application/octet-stream"
 
-    st.write(f"⬆️ Uploading: {file_name}")
+def drive_upload(img_bytes: bytes, file_name: str, mime: str, folder_id: str, svc):
+    from googleapiclient.http import MediaInMemoryUpload, MediaIoBaseUpload
 
-    media = MediaFileUpload(local_path, mimetype=mime, resumable=True)
+    # Small files: a single multipart POST. Resumable uploads cost an extra
+    # session-initiation round-trip, only worth it for large files.
+    if len(img_bytes) < DRIVE_RESUMABLE_THRESHOLD:
+        media = MediaInMemoryUpload(img_bytes, mimetype=mime, resumable=False)
+    else:
+        # chunksize=-1: the bytes are already in memory, send them in one PUT
+        media = MediaIoBaseUpload(io.BytesIO(img_bytes), mimetype=mime, chunksize=-1, resumable=True)
     meta = {"name": file_name, "parents": [folder_id]}
 
+    # num_retries makes googleapiclient back off exponentially (with jitter)
+    # on 403 rate-limit reasons, 429 and 5xx
     svc.files().create(
         body=meta,
         media_body=media,
         fields="id"
-    ).execute()
+    ).execute(num_retries=DRIVE_MAX_RETRIES)
+
+
+_drive_local = threading.local()
+
+
+def thread_drive_service(creds):
+    """
+    Drive service for the current thread.
+    googleapiclient's HTTP object isn't thread-safe, so each upload
+    thread builds and keeps its own (sharing the credentials).
+    """
+    if not hasattr(_drive_local, "svc"):
+        _drive_local.svc = drive_service(creds)
+    return _drive_local.svc
+
+
+def upload_generated_image(item: dict, folder_id: str, creds):
+    """Blocking upload of one generated image; runs in a worker thread."""
+    drive_upload(
+        item["generated_bytes"],
+        f"generated_{item['original_name']}",
+        item["generated_type"],
+        folder_id,
+        thread_drive_service(creds),
+    )
+
+# -------------------------------------------------
+# IMAGE HELPERS
+# -------------------------------------------------
+
+def to_srgb(img: Image.Image, icc_profile: bytes | None) -> Image.Image:
+    """
+    Convert to RGB through the embedded profile when there is one
+    (e.g. CMYK print assets), falling back to a plain conversion.
+    """
+    if icc_profile:
+        try:
+            from PIL import ImageCms  # needs Pillow built with LittleCMS
+
+            return ImageCms.profileToProfile(
+                img,
+                ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                ImageCms.createProfile("sRGB"),
+                outputMode="RGB",
+            )
+        except Exception:
+            pass
+    return img.convert("RGB")
+
+
+def downscale_image(raw_bytes: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    Shrink images whose long edge exceeds MAX_INPUT_EDGE.
+    The models don't need more to read overlay text, and smaller uploads cut
+    both transfer time and image-token cost. Images with transparency are
+    re-encoded as PNG, everything else as JPEG. Small images pass through.
+    EXIF orientation is applied to the pixels (the tag itself isn't kept).
+    The ICC profile is carried over unless the JPEG path has to change the
+    colour mode, in which case the pixels are converted to sRGB instead.
+    """
+    img = Image.open(io.BytesIO(raw_bytes))
+    if max(img.size) <= MAX_INPUT_EDGE:
+        return raw_bytes, mime_type
+
+    icc_profile = img.info.get("icc_profile")
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((MAX_INPUT_EDGE, MAX_INPUT_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img.save(buf, "PNG", optimize=True, icc_profile=icc_profile)
+        return buf.getvalue(), "image/png"
+
+    if img.mode != "RGB":
+        img = to_srgb(img, icc_profile)
+        icc_profile = None  # the source profile no longer describes these pixels
+    img.save(buf, "JPEG", quality=DOWNSCALE_JPEG_QUALITY, optimize=True, icc_profile=icc_profile)
+    return buf.getvalue(), "image/jpeg"
+
+
+def prepare_image(file_data: dict) -> bytes:
+    """
+    Downscale (if oversize) and encode one upload, updating file_data.
+    Called from a worker thread when the image's batch is picked up, so
+    only in-flight images hold a resized copy and Pillow never blocks
+    the Streamlit thread.
+    """
+    file_data["bytes"], file_data["type"] = downscale_image(file_data["bytes"], file_data["type"])
+    return encode_bytes_to_base64(file_data["bytes"], file_data["type"])
 
 # -------------------------------------------------
 # ASYNC OPENROUTER HELPERS
 # -------------------------------------------------
 
-def encode_bytes_to_base64(raw_bytes: bytes, mime_type: str) -> str:
-    """Encode raw bytes to base64 data URL."""
-    return f"data:{mime_type};base64,{base64.b64encode(raw_bytes).decode()}"
+def encode_bytes_to_base64(raw_bytes: bytes, mime_type: str) -> bytes:
+    """
+    Encode raw bytes to base64 data URL.
+    Encodes in chunks straight into one buffer, so no full-size intermediate
+    base64 string is built before the data URL. Returned as ASCII bytes, which
+    dumps_payload splices into the request body as-is.
+    """
+    buf = io.BytesIO()
+    buf.write(f"data:{mime_type};base64,".encode("ascii"))
+    view = memoryview(raw_bytes)
+    for start in range(0, len(view), B64_CHUNK_SIZE):
+        buf.write(binascii.b2a_base64(view[start:start + B64_CHUNK_SIZE], newline=False))
+    return buf.getvalue()
+
+
+def dumps_payload(payload: dict) -> bytes:
+    """
+    Serialize a chat payload to JSON bytes.
+    Image URLs given as bytes are swapped for a random per-call placeholder
+    (so no user text can collide with it), the small rest of the payload goes
+    through orjson, and the URLs are spliced back in verbatim.
+    The base64 alphabet is JSON-safe, so the multi-MB strings never go through
+    the JSON encoder or a bytes -> str round-trip.
+    """
+    urls = []
+    placeholder = f"@@{uuid.uuid4().hex}@@"
+
+    def strip_url(part):
+        if part.get("type") == "image_url" and isinstance(part["image_url"]["url"], bytes):
+            urls.append(part["image_url"]["url"])
+            return {**part, "image_url": {"url": placeholder}}
+        return part
+
+    messages = [
+        {**m, "content": [strip_url(part) for part in m["content"]]}
+        if isinstance(m["content"], list) else m
+        for m in payload["messages"]
+    ]
+    pieces = orjson.dumps({**payload, "messages": messages}).split(placeholder.encode("ascii"))
+    assert len(pieces) == len(urls) + 1, "image URL placeholder found in payload text"
+
+    body = [pieces[0]]
+    for url, piece in zip(urls, pieces[1:]):
+        body += [url, piece]
+    return b"".join(body)
+
+
+def retry_after_seconds(headers) -> float | None:
+    """
+    Parse Retry-After (seconds or HTTP date) or, failing that,
+    X-RateLimit-Reset (epoch ms/s, as OpenRouter sends it).
+    Capped at MAX_RETRY_AFTER.
+    """
+    if not headers:
+        return None
+    now = datetime.now(timezone.utc)
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - now).total_seconds()
+            except (TypeError, ValueError):
+                return None
+    else:
+        try:
+            reset = float(headers.get("X-RateLimit-Reset") or "")
+        except ValueError:
+            return None
+        if reset > 1e12:  # epoch milliseconds
+            reset /= 1000
+        seconds = reset - now.timestamp() if reset > 1e9 else reset
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def backoff_seconds(attempt: int) -> float:
+    # Jitter keeps concurrent retries from hitting the rate limit in lockstep
+    return min(2 ** (attempt - 1) + random.uniform(0, 1), MAX_BACKOFF)
 
 
 async def async_openrouter_call(session: aiohttp.ClientSession, api_key: str, payload: dict, label: str):
     """
     Async HTTP call to OpenRouter with retry logic.
+    408/429/503 wait for the server's Retry-After, other 4xx fail immediately,
+    5xx and connection errors back off exponentially. 429s get their own
+    retry budget so a busy rate limit doesn't use up MAX_RETRIES.
+    Large bodies (base64 images) are gzipped at level 1, which cuts the
+    upload by roughly a quarter for little CPU. Compressed bodies aren't a
+    documented OpenRouter feature, so any client-error reply to a gzipped
+    attempt is retried once as plain JSON (for this call only).
     """
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -118,21 +411,48 @@ async def async_openrouter_call(session: aiohttp.ClientSession, api_key: str, pa
         "X-Title": "Streamlit Image Localization App",
     }
 
+    body = dumps_payload(payload)  # serialize once, reused by retries
+    gz_body = None
+    if len(body) > GZIP_MIN_BYTES:
+        gz_body = await asyncio.to_thread(gzip.compress, body, 1)
+
     last_error = None
+    failures = 0
+    rate_limited = 0
 
-    for attempt in range(1, MAX_RETRIES + 1):
+    while True:
+        delay = None
         try:
             async with session.post(
                 OPENROUTER_URL,
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                headers={**headers, "Content-Encoding": "gzip"} if gz_body else headers,
+                data=gz_body or body,  # Content-Type set in headers
             ) as response:
+                if gz_body and response.status in GZIP_FALLBACK_STATUSES:
+                    # Compressed body possibly not understood; resend plain
+                    last_error = f"{response.status}, message={response.reason!r}"
+                    gz_body = None
+                    continue
                 response.raise_for_status()
-                return await response.json()
+                return orjson.loads(await response.read())
+        except aiohttp.ClientResponseError as e:
+            last_error = str(e)
+            if e.status == 429 and rate_limited < MAX_RATE_LIMIT_RETRIES:
+                rate_limited += 1
+                delay = retry_after_seconds(e.headers)
+                await asyncio.sleep(backoff_seconds(rate_limited) if delay is None else delay)
+                continue
+            if e.status in (408, 429, 503):
+                delay = retry_after_seconds(e.headers)
+            elif 400 <= e.status < 500:
+                raise RuntimeError(f"{label} failed: {last_error}") from e
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             last_error = str(e)
-            await asyncio.sleep(2 ** (attempt - 1))
+
+        failures += 1
+        if failures >= MAX_RETRIES:
+            break
+        await asyncio.sleep(backoff_seconds(failures) if delay is None else delay)
 
     raise RuntimeError(f"{label} failed after retries: {last_error}")
 
@@ -140,85 +460,117 @@ async def async_openrouter_call(session: aiohttp.ClientSession, api_key: str, pa
 # ASYNC AI STEPS
 # -------------------------------------------------
 
-async def async_analyze_localization(session, api_key, image_b64, language, extra):
+async def request_localization(session, api_key, image_content, prompt):
+    """Uncached localization analysis of a single image."""
     payload = {
         "model": ANALYSIS_MODEL,
         "messages": [{
             "role": "user",
             "content": [
-                {"type": "text", "text": f"""You are a meticulous product/visual QA analyst. Your job is to scan a single product image and identify only the text that belongs to infographic/overlay/UI elements that should be localized into {language} for a {language} product page.
+                {"type": "text", "text": prompt},
+                image_content,
+            ],
+        }],
+    }
+    r = await async_openrouter_call(session, api_key, payload, "LOCALIZATION")
+    return r["choices"][0]["message"]["content"]
 
-Critical scope rules:
-Translate:
-- Overlays, badges, banners, callouts, captions, labels, pointers, stickers, ribbons, corner tags, headers, footers.
 
-Do NOT translate:
-- Any text printed on the physical product or packaging.
-- Logos, brand names, model numbers, trademarks, certifications, addresses.
-- URLs, QR codes, barcodes, watermarks, icons.
+def split_batch_localization(text: str, count: int) -> list[str] | None:
+    """
+    Split a batched localization reply into one JSON array string per image.
+    Returns None if the reply isn't a JSON array with exactly `count` entries.
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        per_image = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(per_image, list) or len(per_image) != count:
+        return None
+    return [orjson.dumps(items).decode() for items in per_image]
 
-If unreadable but clearly overlay text, mark as UNREADABLE.
 
-Return STRICT JSON array with:
-- what_text
-- position_hint
-- changed_to
+async def async_analyze_localization_batch(session, api_key, images, prompt):
+    """
+    Localization analysis for several images in a single request.
+    `images` is a list of (image_content, image_hash) pairs; returns one analysis
+    per image, in order. Images whose batched answer can't be matched up are
+    re-analysed one request each.
+    """
+    keys = [
+        llm_cache.make_key("LOCALIZATION", ANALYSIS_MODEL, prompt, image_hash)
+        for _, image_hash in images
+    ]
+    analyses = [llm_cache.cache_get(key) for key in keys]
+    todo = [i for i, analysis in enumerate(analyses) if analysis is None]
+
+    if len(todo) > 1:
+        text = (
+            f"You will receive {len(todo)} images. Apply the instructions below to EACH image "
+            f"independently. Return a JSON array with exactly {len(todo)} elements, in image order, "
+            "where each element is the STRICT JSON array described below for that image.\n\n"
+            + prompt
+        )
+        payload = {
+            "model": ANALYSIS_MODEL,
+            "messages": [{
+                "role": "user",
+                "content": [{"type": "text", "text": text}] + [images[i][0] for i in todo],
+            }],
+        }
+        r = await async_openrouter_call(session, api_key, payload, "LOCALIZATION")
+        per_image = split_batch_localization(r["choices"][0]["message"]["content"], len(todo))
+        if per_image is not None:
+            for i, analysis in zip(todo, per_image):
+                analyses[i] = analysis
+                llm_cache.cache_set(keys[i], analysis)
+            todo = []
 
-Tone: concise, professional ecommerce copy.
-Do not remove or rewrite brand names.
-Preserve numerals and units.
+    for i in todo:
+        analyses[i] = await request_localization(session, api_key, images[i][0], prompt)
+        llm_cache.cache_set(keys[i], analyses[i])
 
-Additional user instructions:
-{extra}"""},
-                {"type": "image_url", "image_url": {"url": image_b64}},
-            ],
-        }],
-    }
-    r = await async_openrouter_call(session, api_key, payload, "LOCALIZATION")
-    return r["choices"][0]["message"]["content"]
+    return analyses
 
 
-async def async_analyze_aspect(session, api_key, image_b64, ratio):
+async def async_analyze_aspect(session, api_key, image_content, image_hash, ratio):
+    key = llm_cache.make_key("ASPECT", ANALYSIS_MODEL, ratio, image_hash)
+    cached = llm_cache.cache_get(key)
+    if cached is not None:
+        return cached
+
     payload = {
         "model": ANALYSIS_MODEL,
         "messages": [{
             "role": "user",
             "content": [
-                {"type": "text", "text": f"""
-You are an expert visual layout and image composition specialist.
-
-Analyze the provided image and describe how to adapt it to a {ratio} aspect ratio, while still keeping all of the original elements of the image.
-
-Guidelines:
-- Preserve the main subject, background and focal point
-- Avoid aggressive cropping of oriiginal elements, rather reposition or resize them
-- Prefer intelligent expansion, repositioning, or background continuation
-- Maintain natural proportions
-- Ensure the image feels native to the target aspect ratio
-- Do not add new objects unless required for balance
-
-Return concise, actionable steps (3-4 bullet points max).
-Plain text only.
-Always add a prefix to your answerstating: Change the given imaget to {ratio} (mention the required aspect ratio) following the idea: followed by your description
-
-just the prefix and the description no preamble or commnetary or explanation
-"""},
-                {"type": "image_url", "image_url": {"url": image_b64}},
+                {"type": "text", "text": ASPECT_PROMPT_TEMPLATE.format(ratio=ratio)},
+                image_content,
             ],
         }],
     }
     r = await async_openrouter_call(session, api_key, payload, "ASPECT")
-    return r["choices"][0]["message"]["content"]
+    content = r["choices"][0]["message"]["content"]
+    llm_cache.cache_set(key, content)
+    return content
 
 
-async def async_generate_image(session, api_key, prompt, image_b64, ratio):
+async def async_generate_image(session, api_key, prompt, image_content, image_hash, ratio):
+    key = llm_cache.make_key("GENERATION", GENERATION_MODEL, prompt, ratio, image_hash)
+    cached = llm_cache.cache_get(key)
+    if cached is not None:
+        return cached
+
     payload = {
         "model": GENERATION_MODEL,
         "messages": [{
             "role": "user",
             "content": [
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": image_b64}},
+                image_content,
             ],
         }],
         "modalities": ["image", "text"],
@@ -228,65 +580,184 @@ async def async_generate_image(session, api_key, prompt, image_b64, ratio):
         payload["image_config"] = {"aspect_ratio": ratio, "image_size": "2K"}
 
     r = await async_openrouter_call(session, api_key, payload, "GENERATION")
-    return r["choices"][0]["message"]["images"][0]["image_url"]["url"]
+    images = r["choices"][0]["message"].get("images")
+    if not images:
+        return None  # text-only reply
+    image_url = images[0]["image_url"]["url"]
+    llm_cache.cache_set(key, image_url)  # data URL stored as-is
+    return image_url
 
 # -------------------------------------------------
 # ASYNC PARALLEL WORKER
 # -------------------------------------------------
 
-async def async_process_single_image(
+async def async_generation_prompts(session, api_key, images, localization_prompt, ratio):
+    """
+    Two-call analysis: localization for all images in one request, plus
+    aspect analysis per image when a ratio is set. The two don't depend on
+    each other, so they run concurrently.
+    Returns one generation prompt per image, or the exception it failed with.
+    """
+    aspect_calls = [
+        async_analyze_aspect(session, api_key, image_content, img_hash, ratio) for image_content, img_hash in images
+    ] if ratio else []
+
+    localizations, *aspects = await asyncio.gather(
+        async_analyze_localization_batch(session, api_key, images, localization_prompt),
+        *aspect_calls,
+        return_exceptions=True,
+    )
+    if isinstance(localizations, Exception):
+        return [localizations] * len(images)
+    if not ratio:
+        aspects = [None] * len(images)
+
+    return [
+        aspect if isinstance(aspect, Exception)
+        else f"{aspect}\n\n{localization}" if aspect else localization
+        for localization, aspect in zip(localizations, aspects)
+    ]
+
+
+def failed_result(index: int, file_data: dict, error: str, start_time: float) -> dict:
+    return {
+        "success": False,
+        "index": index,
+        "original_name": file_data["name"],
+        "original_bytes": file_data["bytes"],
+        "original_type": file_data["type"],
+        "error": error,
+        "elapsed_seconds": round(time.time() - start_time, 2),
+    }
+
+
+async def async_analyze_batch(
     session: aiohttp.ClientSession,
     api_key: str,
-    file_data: dict,
-    language: str,
-    extra: str,
+    batch: list,
+    localization_prompt: str,
     ratio: str | None,
-    index: int,
 ):
     """
-    Process a single image asynchronously.
-    Returns result dict with timing info.
+    Analysis stage for a batch of (index, file_data) pairs.
+    Returns one staged dict (carrying the generation prompt) or failed
+    result dict per image. In COMBINED_MODE no analysis calls are made.
     """
     start_time = time.time()
-    file_name = file_data["name"]
-    
+
+    # Downscale + encode once (reused by the generation stage), off the event loop
+    encoded = await asyncio.gather(*[
+        asyncio.to_thread(prepare_image, fd) for _, fd in batch
+    ], return_exceptions=True)
+
+    staged = []
+    ready = []
+    for (index, file_data), img_b64 in zip(batch, encoded):
+        if isinstance(img_b64, Exception):
+            # Corrupt or unsupported upload: fail this image, not the batch
+            staged.append(failed_result(index, file_data, f"Could not read image: {img_b64}", start_time))
+        else:
+            ready.append((index, file_data, img_b64))
+    if not ready:
+        return staged
+
+    # One image content part per image, shared by every request that sends it
+    images = [
+        ({"type": "image_url", "image_url": {"url": img_b64}}, fd["hash"])
+        for _, fd, img_b64 in ready
+    ]
+
+    if COMBINED_MODE:
+        prompts = [f"{localization_prompt}\n\n{COMBINED_INSTRUCTIONS}"] * len(ready)
+    else:
+        prompts = await async_generation_prompts(session, api_key, images, localization_prompt, ratio)
+
+    for (index, file_data, _), (image_content, img_hash), prompt in zip(ready, images, prompts):
+        if isinstance(prompt, Exception):
+            staged.append(failed_result(index, file_data, str(prompt), start_time))
+            continue
+
+        staged.append({
+            "success": True,
+            "index": index,
+            "original_name": file_data["name"],
+            "original_bytes": file_data["bytes"],
+            "original_type": file_data["type"],
+            "image_content": image_content,
+            "image_hash": img_hash,
+            "prompt": prompt,
+            "localization_prompt": localization_prompt,
+            "combined": COMBINED_MODE,
+            "start_time": start_time,
+        })
+
+    return staged
+
+
+async def async_generate_single_image(
+    session: aiohttp.ClientSession,
+    api_key: str,
+    staged: dict,
+    ratio: str | None,
+):
+    """
+    Generation stage for a single analysed image.
+    Returns result dict with timing info.
+    """
+    start_time = staged["start_time"]
+
     try:
-        img_b64 = encode_bytes_to_base64(file_data["bytes"], file_data["type"])
+        image_url = await async_generate_image(
+            session, api_key, staged["prompt"], staged["image_content"], staged["image_hash"], ratio
+        )
 
-        # Run localization analysis
-        localization = await async_analyze_localization(session, api_key, img_b64, language, extra)
-        prompt = localization
+        if image_url is None and staged["combined"]:
+            # Single-call mode gave text only; fall back to analysis + generation
+            image = (staged["image_content"], staged["image_hash"])
+            [prompt] = await async_generation_prompts(
+                session, api_key, [image], staged["localization_prompt"], ratio
+            )
+            if isinstance(prompt, Exception):
+                raise prompt
+            image_url = await async_generate_image(session, api_key, prompt, *image, ratio)
 
-        # Run aspect analysis if needed
-        if ratio:
-            aspect = await async_analyze_aspect(session, api_key, img_b64, ratio)
-            prompt = f"{aspect}\n\n{localization}"
+        if image_url is None:
+            raise RuntimeError("GENERATION returned text but no image")
 
-        # Generate the final image
-        image_url = await async_generate_image(session, api_key, prompt, img_b64, ratio)
+        # Decode once; display, Drive upload and ZIP all reuse these bytes
+        header, encoded = image_url.split(",", 1)
+        generated_type = header.removeprefix("data:").split(";", 1)[0] or "application/octet-stream"
+        generated_bytes = await asyncio.to_thread(base64.b64decode, encoded)
 
         elapsed = time.time() - start_time
-        
+
         return {
             "success": True,
-            "index": index,
-            "original_name": file_name,
-            "original_b64": img_b64,  # Store original for side-by-side display
-            "generated_image": image_url,
+            "index": staged["index"],
+            "original_name": staged["original_name"],
+            "original_bytes": staged["original_bytes"],  # Store original for side-by-side display
+            "original_type": staged["original_type"],
+            "generated_bytes": generated_bytes,
+            "generated_type": generated_type,
             "elapsed_seconds": round(elapsed, 2),
         }
-    
+
     except Exception as e:
         elapsed = time.time() - start_time
         return {
             "success": False,
-            "index": index,
-            "original_name": file_name,
-            "original_b64": encode_bytes_to_base64(file_data["bytes"], file_data["type"]),
+            "index": staged["index"],
+            "original_name": staged["original_name"],
+            "original_bytes": staged["original_bytes"],
+            "original_type": staged["original_type"],
             "error": str(e),
             "elapsed_seconds": round(elapsed, 2),
         }
 
+    finally:
+        # The data URL is only needed for the requests; release it right away
+        del staged["image_content"]
+
 
 async def process_all_images_async(
     api_key: str,
@@ -294,31 +765,143 @@ async def process_all_images_async(
     language: str,
     extra: str,
     ratio: str | None,
+    on_result=None,
+    drive_folder_id: str | None = None,
+    drive_creds=None,
 ):
     """
-    Process all images in TRUE parallel using asyncio.
+    Process all images as a two-stage pipeline.
+
+    MAX_WORKERS analysis workers take batches of ANALYSIS_BATCH_SIZE images
+    and feed an asyncio.Queue that MAX_WORKERS generation workers drain, so
+    an image starts generating as soon as its analysis is done while other
+    images are still being analysed.
+
+    Storage overlaps with generation: each successful result is handed to
+    `on_result` (e.g. to add it to the ZIP) and, if `drive_folder_id` is
+    set, its Drive upload starts right away (at most
+    DRIVE_MAX_PARALLEL_UPLOADS at a time). Upload outcome is recorded on
+    the result as "drive_error" (None on success).
     """
     # Create a single session for connection pooling
-    connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
-    
-    async with aiohttp.ClientSession(connector=connector) as session:
-        # Create all tasks
-        tasks = [
-            async_process_single_image(
-                session, api_key, fd, language, extra, ratio, i
-            )
-            for i, fd in enumerate(file_data_list)
-        ]
-        
-        # Run ALL tasks concurrently and gather results
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        return results
+    # (both stages are in flight at once, so size the pool for both).
+    # Everything goes to openrouter.ai, so the per-host cap is the real limit;
+    # long keepalive + DNS caching let the N*2 calls reuse warm TLS connections.
+    # Analysis fans out to more requests than sockets (batched localization
+    # plus one aspect call per image), so the excess waits for a connection;
+    # REQUEST_TIMEOUT doesn't count that wait.
+    connector = aiohttp.TCPConnector(
+        limit=MAX_WORKERS * 2,
+        limit_per_host=MAX_WORKERS * 2,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+
+    localization_prompt = LOCALIZATION_PROMPT_TEMPLATE.format(language=language, extra=extra)
+
+    # Identical uploads are processed once and fanned back out at the end
+    first_index = {}  # image hash -> index of its first occurrence
+    duplicates = []  # (index, index of the first occurrence)
+    indexed = []
+    hashes = await asyncio.gather(*[
+        asyncio.to_thread(llm_cache.image_hash, fd["bytes"]) for fd in file_data_list
+    ])
+    for i, (fd, image_hash) in enumerate(zip(file_data_list, hashes)):
+        fd["hash"] = image_hash
+        if fd["hash"] in first_index:
+            duplicates.append((i, first_index[fd["hash"]]))
+        else:
+            first_index[fd["hash"]] = i
+            indexed.append((i, fd))
+
+    pending = asyncio.Queue()
+    for b in range(0, len(indexed), ANALYSIS_BATCH_SIZE):
+        pending.put_nowait(indexed[b:b + ANALYSIS_BATCH_SIZE])
+
+    # Bounded, so analysis can't run ahead of generation and pile up
+    # every image's base64 payload in memory
+    analysed = asyncio.Queue(maxsize=MAX_WORKERS)
+    results = []
+
+    upload_sem = asyncio.Semaphore(DRIVE_MAX_PARALLEL_UPLOADS)
+    uploads = []
+
+    async def upload(result):
+        async with upload_sem:
+            try:
+                await asyncio.to_thread(upload_generated_image, result, drive_folder_id, drive_creds)
+                result["drive_error"] = None
+            except Exception as e:
+                result["drive_error"] = str(e)
+
+    def finish(result):
+        results.append(result)
+        if not result["success"]:
+            return
+        if on_result:
+            try:
+                on_result(result)
+            except Exception as e:
+                # Runs inside a worker: fail this result, keep the pipeline going
+                result["success"] = False
+                result["error"] = f"Could not store result: {e}"
+                return
+        if drive_folder_id:
+            uploads.append(asyncio.create_task(upload(result)))
+
+    async with aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT) as session:
+
+        async def analysis_worker():
+            while True:
+                try:
+                    batch = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                for staged in await async_analyze_batch(
+                    session, api_key, batch, localization_prompt, ratio
+                ):
+                    if staged["success"]:
+                        await analysed.put(staged)
+                    else:
+                        finish(staged)
+
+        async def generation_worker():
+            while True:
+                staged = await analysed.get()
+                if staged is None:
+                    return
+                finish(await async_generate_single_image(session, api_key, staged, ratio))
+
+        generators = [asyncio.create_task(generation_worker()) for _ in range(MAX_WORKERS)]
+
+        # Wait for every image to be analysed, then tell generators to stop
+        await asyncio.gather(*[analysis_worker() for _ in range(MAX_WORKERS)])
+        for _ in generators:
+            await analysed.put(None)
+        await asyncio.gather(*generators)
+
+    by_index = {r["index"]: r for r in results}
+    for i, first in duplicates:
+        finish({
+            **by_index[first],
+            "index": i,
+            "original_name": file_data_list[i]["name"],
+        })
+
+    await asyncio.gather(*uploads)
+    return results
 
 # -------------------------------------------------
 # STREAMLIT APP
 # -------------------------------------------------
 
+def show_cache_stats(placeholder):
+    placeholder.caption(
+        f"LLM cache: {llm_cache.stats['hits']} hits / {llm_cache.stats['misses']} misses"
+    )
+
+
 def main():
     st.set_page_config(page_title="AI Image Localization", layout="wide")
     st.title("AI Marketing Image Localization")
@@ -336,6 +919,8 @@ def main():
             "Upload Images", type=["jpg", "jpeg", "png"], accept_multiple_files=True
         )
         run = st.button("Process Images", type="primary")
+        cache_stats = st.empty()
+        show_cache_stats(cache_stats)
 
     if not run or not api_key or not files:
         return
@@ -343,19 +928,20 @@ def main():
     ratio = ASPECT_RATIO_OPTIONS[ratio_label]
 
     drive_enabled = bool(drive_url.strip())
-    drive_svc = None
+    drive_creds = None
     folder_id = None
 
     if drive_enabled:
         folder_id = extract_folder_id(drive_url)
-        drive_svc = drive_service()
-        if not verify_drive_folder_access(folder_id, drive_svc):
+        drive_creds = drive_credentials()
+        if not verify_drive_folder_access([folder_id], thread_drive_service(drive_creds)):
             st.stop()
 
     # -------------------------------------------------
-    # PRE-READ ALL FILES IN MAIN THREAD
+    # COLLECT FILES (resizing happens lazily in the pipeline)
     # -------------------------------------------------
     
+    # getvalue() shares the uploader's buffer rather than copying it
     file_data_list = []
     for f in files:
         file_data_list.append({
@@ -375,16 +961,40 @@ def main():
     # -------------------------------------------------
     
     overall_start = time.time()
-    
-    with st.spinner(f"Processing {num_images} images..."):
-        # Run the async function
-        results = asyncio.run(
-            process_all_images_async(
-                api_key, file_data_list, language, extra, ratio
-            )
-        )
+
+    spinner_text = f"Processing {num_images} images..."
+    if drive_enabled:
+        spinner_text = f"Processing and uploading {num_images} images..."
+
+    # The ZIP is filled as each image finishes, while others still generate.
+    # Spooled: small archives stay in memory, large ones spill to disk
+    # instead of growing (and re-allocating) one big in-memory buffer.
+    # Both are closed (and any spill file removed) even if the run fails.
+    with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE) as zip_spool:
+        # Images are already compressed; DEFLATE would only burn CPU
+        with zipfile.ZipFile(zip_spool, "w", zipfile.ZIP_STORED) as zipf:
+
+            def add_to_zip(result):
+                zipf.writestr(f"generated_{result['original_name']}", result["generated_bytes"])
+
+            with st.spinner(spinner_text):
+                # Run the async function
+                results = asyncio.run(
+                    process_all_images_async(
+                        api_key, file_data_list, language, extra, ratio,
+                        on_result=add_to_zip,
+                        drive_folder_id=folder_id,
+                        drive_creds=drive_creds,
+                    )
+                )
+
+        # download_button only accepts bytes or BytesIO/BufferedReader,
+        # so take the finished archive in one read
+        zip_spool.seek(0)
+        zip_bytes = zip_spool.read()
     
     overall_elapsed = time.time() - overall_start
+    show_cache_stats(cache_stats)
 
     # -------------------------------------------------
     # DISPLAY RESULTS SIDE-BY-SIDE
@@ -422,54 +1032,39 @@ def main():
             
             with col_orig:
                 st.markdown("**Original**")
-                st.image(result["original_b64"], use_container_width=True)
+                st.image(io.BytesIO(result["original_bytes"]), use_container_width=True)
             
             with col_gen:
                 st.markdown("**Generated**")
-                st.image(result["generated_image"], use_container_width=True)
+                st.image(io.BytesIO(result["generated_bytes"]), use_container_width=True)
             
             st.divider()
         else:
             st.error(f"❌ Failed: {result['original_name']} - {result.get('error', 'Unknown error')}")
 
     # -------------------------------------------------
-    # DRIVE UPLOAD (SERIAL, AFTER ALL DONE)
+    # DRIVE UPLOAD (STARTED AS EACH IMAGE FINISHED)
     # -------------------------------------------------
 
     if drive_enabled and st.session_state.results:
-        st.subheader("Uploading to Google Drive")
+        st.subheader("Google Drive Upload")
         for item in st.session_state.results:
-            header, encoded = item["generated_image"].split(",", 1)
-            img_bytes = base64.b64decode(encoded)
-
-            local_path = os.path.join(
-                TEMP_DIR, f"generated_{item['original_name']}"
-            )
-            with open(local_path, "wb") as f:
-                f.write(img_bytes)
+            if item["drive_error"]:
+                st.error(f"❌ Upload failed: {item['original_name']} - {item['drive_error']}")
+            else:
+                st.write(f"⬆️ Uploaded: generated_{item['original_name']}")
 
-            drive_upload(local_path, folder_id, drive_svc)
-            os.remove(local_path)
-
-        st.success("✅ All images uploaded to Google Drive")
+        if not any(item["drive_error"] for item in st.session_state.results):
+            st.success("✅ All images uploaded to Google Drive")
 
     # -------------------------------------------------
     # ZIP DOWNLOAD
     # -------------------------------------------------
 
     if st.session_state.results:
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for item in st.session_state.results:
-                header, encoded = item["generated_image"].split(",", 1)
-                zipf.writestr(
-                    f"generated_{item['original_name']}",
-                    base64.b64decode(encoded),
-                )
-
         st.download_button(
             "📥 Download All Images (ZIP)",
-            zip_buffer.getvalue(),
+            zip_bytes,
             "generated_images.zip",
             "application/zip",
         )